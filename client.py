@@ -51,7 +51,8 @@ def process_input(history: list[dict], tools: list[dict], role_name_replace: dic
         }
         if conversation.metadata:
             item["metadata"] = conversation.metadata
-        # Only append image for user
+        # Only append image for user, as the hash from the image store. Clients
+        # feeding pixels to a model resolve it themselves.
         if role == "user" and conversation.image:
             item["image"] = conversation.image
         chat_history.append(item)
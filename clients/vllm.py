@@ -13,6 +13,7 @@ from vllm import SamplingParams, LLMEngine, EngineArgs
 
 from client import Client, process_input, process_response
 from conversation import Conversation
+from journal import PromptCache
 
 
 class VLLMClient(Client):
@@ -31,6 +32,27 @@ class VLLMClient(Client):
         )
         self.engine = LLMEngine.from_engine_args(self.engine_args)
 
+    def tokenize_prompt(self, text: str, prompt_cache: PromptCache | None) -> list[int]:
+        """
+        Tokenize the prompt, reusing the cached tokens of the previous prompt of the session.
+        """
+        cached = prompt_cache.lookup(text) if prompt_cache else None
+        # Only reuse a prefix ending with a special token, so that no token
+        # spans the boundary between the cached and the new part.
+        if cached and any(
+                text.endswith(token, 0, cached[0])
+                for token in self.tokenizer.all_special_tokens
+        ):
+            prefix_len, token_ids = cached
+            token_ids = token_ids + self.tokenizer.encode(
+                text[prefix_len:], add_special_tokens=False
+            )
+        else:
+            token_ids = self.tokenizer.encode(text)
+        if prompt_cache:
+            prompt_cache.store(text, token_ids)
+        return token_ids
+
     def generate_stream(
         self, tools: list[dict], history: list[Conversation], **parameters
     ) -> Generator[tuple[str | dict, list[dict]]]:
@@ -39,6 +61,9 @@ class VLLMClient(Client):
             chat_history, add_generation_prompt=True, tokenize=False
         )
         print(f'model_inputs:{model_inputs}')
+        prompt_token_ids = self.tokenize_prompt(
+            model_inputs, parameters.pop("prompt_cache", None)
+        )
         parameters["max_tokens"] = parameters.pop("max_new_tokens")
         params_dict = {
             "n": 1,
@@ -61,7 +86,9 @@ class VLLMClient(Client):
         sampling_params = SamplingParams(**params_dict)
 
         self.engine.add_request(
-            request_id=str(time.time()), inputs=model_inputs, params=sampling_params
+            request_id=str(time.time()),
+            inputs={"prompt": model_inputs, "prompt_token_ids": prompt_token_ids},
+            params=sampling_params,
         )
         while self.engine.has_unfinished_requests():
             request_outputs = self.engine.step()
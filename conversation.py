@@ -9,6 +9,8 @@ from streamlit.delta_generator import DeltaGenerator
 
 from PIL.Image import Image
 
+from image_store import image_source
+
 QUOTE_REGEX = re.compile(r"【(\d+)†(.+?)】")
 
 SELFCOG_PROMPT = "你是一个名为 TeleAgent 的人工智能助手。你是基于星辰大模型开发的，你的任务是针对用户的问题和要求提供适当的答复和支持。"
@@ -84,6 +86,7 @@ class Conversation:
     # Processed content
     saved_content: str | None = None
     metadata: str | None = None
+    # Image hash from the image store, or a raw image / url
     image: str | Image | None = None
 
     def __str__(self) -> str:
@@ -108,7 +111,7 @@ class Conversation:
             message = self.role.get_message()
 
         if self.image:
-            message.image(self.image, width=512)
+            message.image(image_source(self.image), width=512)
 
         if self.role == Role.OBSERVATION:
             metadata_str = f"from {self.metadata}" if self.metadata else ""
@@ -0,0 +1,80 @@
+"""
+Content-addressed image store for multimodal conversations.
+
+Uploaded images are decoded, resized and normalized once, then written to disk
+under their content hash. Conversation history and the model chat history
+only keep the hash; clients that feed pixels to a model open the stored file.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from io import BytesIO
+
+import streamlit as st
+
+from PIL import Image, ImageOps
+
+IMAGE_CACHE_DIR = "./cache/images"
+MAX_IMAGE_SIDE = 1120
+IMAGE_QUALITY = 90
+
+IMAGE_ID_REGEX = re.compile(r"[0-9a-f]{64}")
+
+
+class ImageStore:
+    def __init__(self, root: str = IMAGE_CACHE_DIR, max_side: int = MAX_IMAGE_SIDE):
+        self.root = root
+        self.max_side = max_side
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, image_id: str) -> str:
+        return os.path.join(self.root, f"{image_id}.jpg")
+
+    def add(self, data: bytes | Image.Image) -> str:
+        """
+        Normalize an image and store it, returning its content hash.
+        """
+        if isinstance(data, Image.Image):
+            image = data
+        else:
+            image = Image.open(BytesIO(data))
+            # Let JPEGs decode at a reduced scale instead of at full size
+            image.draft("RGB", (self.max_side, self.max_side))
+        # The stored image drops EXIF, so apply its orientation before converting
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((self.max_side, self.max_side), Image.Resampling.BICUBIC)
+
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=IMAGE_QUALITY)
+        encoded = buffer.getvalue()
+        image_id = hashlib.sha256(encoded).hexdigest()
+
+        path = self.path(image_id)
+        if not os.path.exists(path):
+            # Write to a temporary file first so readers never see a partial image
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(encoded)
+            os.replace(tmp_path, path)
+        return image_id
+
+
+def is_image_id(image: str | Image.Image | None) -> bool:
+    return isinstance(image, str) and IMAGE_ID_REGEX.fullmatch(image) is not None
+
+
+def image_source(image: str | Image.Image | None) -> str | Image.Image | None:
+    """
+    Resolve an image reference from history into something `st.image` can show.
+    Stored images are served from their file, so reruns do not re-encode them.
+    """
+    if is_image_id(image):
+        return get_image_store().path(image)
+    return image
+
+
+@st.cache_resource(max_entries=1)
+def get_image_store() -> ImageStore:
+    return ImageStore()
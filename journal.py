@@ -0,0 +1,272 @@
+"""
+Persistent conversation journal.
+
+Every conversation piece is appended to a SQLite database in WAL mode by a
+background writer thread, so the request path never waits on disk. Turns are
+keyed by (session_id, seq), which makes restoring a session a single index
+range scan. The tokenized prompt of the last model call is journaled as well,
+so a restored session does not need to re-tokenize its history.
+
+Each session is owned by the browser tab that restored it last; writes from
+any other tab sharing the session id are dropped. The database and the image
+store live on local disk, so a session can only be restored on the node that
+wrote it: SQLite in WAL mode does not work on network filesystems.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+from array import array
+
+import streamlit as st
+
+from conversation import Conversation, Role
+
+JOURNAL_PATH = "./cache/journal.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS turns (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    is_json INTEGER NOT NULL,
+    saved_content TEXT,
+    metadata TEXT,
+    image TEXT,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS prompts (
+    session_id TEXT PRIMARY KEY,
+    prompt_len INTEGER NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    token_ids BLOB NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Appended to every write, so that only the owner of a session changes it
+_OWNER_CHECK = "EXISTS (SELECT 1 FROM sessions WHERE session_id = ? AND owner = ?)"
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def hash_prompt(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class PromptCache:
+    """
+    Tokenized prompt of the last model call of a session.
+    """
+
+    def __init__(
+            self,
+            journal: "ConversationJournal",
+            session_id: str,
+            owner: str,
+            entry: tuple[int, str, list[int]] | None = None,
+    ):
+        self.journal = journal
+        self.session_id = session_id
+        self.owner = owner
+        self.entry = entry
+
+    def lookup(self, text: str) -> tuple[int, list[int]] | None:
+        """
+        Return (prefix length, token ids) if the cached prompt is a prefix of `text`.
+        """
+        if self.entry is None:
+            return None
+        prompt_len, prompt_hash, token_ids = self.entry
+        if len(text) < prompt_len or hash_prompt(text[:prompt_len]) != prompt_hash:
+            return None
+        return prompt_len, token_ids
+
+    def store(self, text: str, token_ids: list[int]) -> None:
+        self.entry = (len(text), hash_prompt(text), token_ids)
+        self.journal.save_prompt_tokens(self.session_id, self.owner, *self.entry)
+
+
+class ConversationJournal:
+    def __init__(self, path: str = JOURNAL_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._conn = _connect(path)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[tuple[str, str, tuple]] = queue.Queue()
+        # Number of queued writes per session, so a restore only waits for its own
+        self._pending: dict[str, int] = {}
+        self._pending_changed = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        # The writer is a daemon thread, drain the queue before the process exits
+        atexit.register(self.flush)
+
+    def _write_loop(self) -> None:
+        conn = _connect(self.path)
+        while True:
+            ops = [self._queue.get()]
+            # Batch whatever is pending into one transaction
+            while True:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Catch everything, as any exception escaping here would stop the writer for good
+            try:
+                with conn:
+                    for _, sql, args in ops:
+                        conn.execute(sql, args)
+            except Exception:
+                # Retry one by one, so a bad write does not lose the rest of the batch
+                for _, sql, args in ops:
+                    try:
+                        with conn:
+                            conn.execute(sql, args)
+                    except Exception as e:
+                        print(f"Failed to write conversation journal: {e}")
+            finally:
+                with self._pending_changed:
+                    for session_id, _, _ in ops:
+                        self._pending[session_id] -= 1
+                        if not self._pending[session_id]:
+                            del self._pending[session_id]
+                    self._pending_changed.notify_all()
+
+    def _put(self, session_id: str, sql: str, args: tuple) -> None:
+        with self._pending_changed:
+            self._pending[session_id] = self._pending.get(session_id, 0) + 1
+        self._queue.put((session_id, sql, args))
+
+    def append(self, session_id: str, owner: str, seq: int, conversation: Conversation) -> None:
+        content = conversation.content
+        is_json = not isinstance(content, str)
+        if is_json:
+            content = json.dumps(content, ensure_ascii=False)
+        image = conversation.image if isinstance(conversation.image, str) else None
+        self._put(
+            session_id,
+            f"INSERT OR REPLACE INTO turns SELECT ?, ?, ?, ?, ?, ?, ?, ? WHERE {_OWNER_CHECK}",
+            (
+                session_id,
+                seq,
+                conversation.role.value,
+                content,
+                is_json,
+                conversation.saved_content,
+                conversation.metadata,
+                image,
+                session_id,
+                owner,
+            ),
+        )
+
+    def truncate(self, session_id: str, owner: str, seq: int = 0) -> None:
+        """
+        Drop every turn of the session from `seq` on.
+        """
+        self._put(
+            session_id,
+            f"DELETE FROM turns WHERE session_id = ? AND seq >= ? AND {_OWNER_CHECK}",
+            (session_id, seq, session_id, owner),
+        )
+        if seq == 0:
+            self._put(
+                session_id,
+                f"DELETE FROM prompts WHERE session_id = ? AND {_OWNER_CHECK}",
+                (session_id, session_id, owner),
+            )
+
+    def save_prompt_tokens(
+            self,
+            session_id: str,
+            owner: str,
+            prompt_len: int,
+            prompt_hash: str,
+            token_ids: list[int],
+    ) -> None:
+        self._put(
+            session_id,
+            f"INSERT OR REPLACE INTO prompts SELECT ?, ?, ?, ? WHERE {_OWNER_CHECK}",
+            (
+                session_id,
+                prompt_len,
+                prompt_hash,
+                array("I", token_ids).tobytes(),
+                session_id,
+                owner,
+            ),
+        )
+
+    def flush(self, session_id: str | None = None) -> None:
+        """
+        Wait until the queued writes of a session, or of all sessions, are on disk.
+        """
+        with self._pending_changed:
+            # Wake up periodically, so a dead writer cannot block us forever
+            while self._writer.is_alive():
+                pending = self._pending.get(session_id) if session_id else self._pending
+                if not pending:
+                    return
+                self._pending_changed.wait(timeout=1.0)
+
+    def is_owner(self, session_id: str, owner: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT owner FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row is not None and row[0] == owner
+
+    def restore(self, session_id: str, owner: str) -> tuple[list[Conversation], PromptCache]:
+        """
+        Take ownership of a session and rebuild its history and prompt token cache.
+        """
+        self.flush(session_id)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?)", (session_id, owner)
+            )
+            rows = self._conn.execute(
+                "SELECT role, content, is_json, saved_content, metadata, image "
+                "FROM turns WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+            prompt_row = self._conn.execute(
+                "SELECT prompt_len, prompt_hash, token_ids FROM prompts WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+
+        history = [
+            Conversation(
+                Role(role),
+                json.loads(content) if is_json else content,
+                saved_content,
+                metadata,
+                image,
+            )
+            for role, content, is_json, saved_content, metadata, image in rows
+        ]
+        entry = None
+        if prompt_row:
+            prompt_len, prompt_hash, token_ids = prompt_row
+            entry = (prompt_len, prompt_hash, array("I", token_ids).tolist())
+        return history, PromptCache(self, session_id, owner, entry)
+
+
+@st.cache_resource(max_entries=1)
+def get_journal() -> ConversationJournal:
+    return ConversationJournal()
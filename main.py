@@ -7,7 +7,7 @@ from uuid import uuid4
 import streamlit as st
 from streamlit.delta_generator import DeltaGenerator
 
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 
 from client import Client, ClientType, get_client
 from conversation import (
@@ -16,9 +16,12 @@ from conversation import (
     postprocess_text,
     response_to_str,
 )
+from image_store import get_image_store
+from journal import PromptCache, get_journal
 from tools.tool_registry import dispatch_tool, get_tools
 
 CHAT_MODEL_PATH = "./models/glm-4-9b-chat"
+MESSAGE_PAGE_SIZE = 20
 
 
 def append_conversation(
@@ -27,9 +30,10 @@ def append_conversation(
         placeholder: DeltaGenerator | None = None,
 ) -> None:
     """
-    Append a conversation piece into history, meanwhile show it in a new markdown block
+    Append a conversation piece into history and the journal, meanwhile show it in a new markdown block
     """
     history.append(conversation)
+    journal.append(session_id, journal_owner, len(history) - 1, conversation)
     conversation.show(placeholder)
 
 
@@ -48,19 +52,37 @@ with st.sidebar:
     temperature = st.slider("temperature", 0.0, 1.5, 0.95, step=0.01)
     repetition_penalty = st.slider("repetition_penalty", 0.0, 2.0, 1.0, step=0.01)
     max_new_tokens = st.slider("max_new_tokens", 1, 4096, 2048, step=1)
+    uploaded_image = st.file_uploader("Image", type=["png", "jpg", "jpeg", "webp"])
     cols = st.columns(2)
     export_btn = cols[0]
     clear_history = cols[1].button("Clear", use_container_width=True)
     retry = export_btn.button("Retry", use_container_width=True)
 
+# The session id lives in the url, so reconnecting to this node restores the
+# conversation from the journal. The tab that restored it last owns it.
+session_id = st.query_params.get("session") or uuid4().hex
+st.query_params["session"] = session_id
+journal = get_journal()
+journal_owner = st.session_state.setdefault("journal_owner", uuid4().hex)
+
 if clear_history:
     client = st.session_state.client
+    # Keep the id of the upload already handled, so it is not attached again
+    image_file_id = st.session_state.get("image_file_id")
     st.session_state.clear()
     st.session_state.client = client
+    st.session_state.image_file_id = image_file_id
+    st.session_state.journal_owner = journal_owner
     st.session_state.history = []
+    st.session_state.prompt_cache = PromptCache(journal, session_id, journal_owner)
+    journal.truncate(session_id, journal_owner)
 
 if "history" not in st.session_state:
-    st.session_state.history = []
+    st.session_state.history, st.session_state.prompt_cache = journal.restore(
+        session_id, journal_owner
+    )
+elif not journal.is_owner(session_id, journal_owner):
+    st.warning("This conversation was opened in another tab, changes here are no longer saved.")
 
 st.session_state.client = get_client(model_path=CHAT_MODEL_PATH, typ=ClientType.VLLM)
 
@@ -69,10 +91,12 @@ prompt_text = st.chat_input("Chat with GLM-4!", key="chat_input")
 if prompt_text == "" and retry == False:
     print("\n== Clean ==\n")
     st.session_state.history = []
+    journal.truncate(session_id, journal_owner)
     exit()
 
 history: list[Conversation] = st.session_state.history
 
+retry_image = None
 if retry:
     print("\n== Retry ==\n")
     last_user_conversation_idx = None
@@ -81,10 +105,26 @@ if retry:
             last_user_conversation_idx = idx
     if last_user_conversation_idx is not None:
         prompt_text = history[last_user_conversation_idx].content
+        retry_image = history[last_user_conversation_idx].image
         print(f"New prompt: {prompt_text}, idx = {last_user_conversation_idx}")
         del history[last_user_conversation_idx:]
+        journal.truncate(session_id, journal_owner, last_user_conversation_idx)
+
+
+def show_earlier_messages():
+    st.session_state.shown_messages += MESSAGE_PAGE_SIZE
 
-for conversation in history:
+
+# The whole history is kept in memory for the prompt, but only the latest
+# messages (tool calls and observations included) are rendered.
+shown_messages = st.session_state.setdefault("shown_messages", MESSAGE_PAGE_SIZE)
+hidden_messages = max(len(history) - shown_messages, 0)
+if hidden_messages > 0:
+    st.button(
+        f"Show earlier messages ({hidden_messages})", on_click=show_earlier_messages
+    )
+
+for conversation in history[hidden_messages:]:
     conversation.show()
 
 tools = get_tools()
@@ -99,8 +139,19 @@ def main(prompt_text: str):
     if prompt_text:
         prompt_text = prompt_text.strip()
 
+        # Only keep the image hash in history, the store holds the processed image,
+        # and each upload is attached to the first prompt sent after it.
+        image = retry_image
+        if uploaded_image is not None and uploaded_image.file_id != st.session_state.get("image_file_id"):
+            st.session_state.image_file_id = uploaded_image.file_id
+            try:
+                image = get_image_store().add(uploaded_image.getvalue())
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+                st.error(f"Failed to read image `{uploaded_image.name}`: {e}")
+                return
+
         role = Role.USER
-        append_conversation(Conversation(role, prompt_text), history)
+        append_conversation(Conversation(role, prompt_text, image=image), history)
 
         placeholder = st.container()
         message_placeholder = placeholder.chat_message(
@@ -148,6 +199,7 @@ def main(prompt_text: str):
                         top_k=top_k,
                         repetition_penalty=repetition_penalty,
                         max_new_tokens=max_new_tokens,
+                        prompt_cache=st.session_state.prompt_cache,
                 ):
                     if history_len is None:
                         history_len = len(chat_history)